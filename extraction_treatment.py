@@ -1,18 +1,30 @@
+import numpy as np
 import pandas as pd
+import io
+import json
 import os
-from datetime import datetime
 from dotenv import load_dotenv
 import re
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import pyarrow as pa
+import pyarrow.parquet as pq
 import psycopg2
 from psycopg2 import sql
+from psycopg2.extras import execute_values
 
 # Configuration initiale
 load_dotenv()
 pd.set_option('display.max_columns', None)
 
 # Constantes
-ID_PATTERN = r":\d+"
+ID_PATTERN = r":(\d+)"
+ID_REGEX = re.compile(ID_PATTERN)
 DATE_FORMATS = ["%m/%d/%y", "%d-%b-%y", "%Y-%m-%d"]
+BATCH_SIZE = 1000  # Au-delà, les données sont chargées via COPY
+PARQUET_CACHE_FILE = ".clean.parquet"  # Cache des données nettoyées, dans le dossier des CSV
+PARQUET_CACHE_METADATA_KEY = b"etl_cache_key"
+PARQUET_CACHE_VERSION = 1  # À incrémenter quand le nettoyage des données change
 SELECTED_COLUMNS = [
     'id', 'country', 'shipment_mode', 'scheduled_delivery_date',
     'delivered_to_client_date', 'delivery_recorded_date',
@@ -22,15 +34,107 @@ SELECTED_COLUMNS = [
     'line_item_value', 'unit_price', 'weight_kilograms',
     'freight_cost_usd', 'line_item_insurance_usd'
 ]
+PRODUCT_COLUMNS = [
+    'product_group', 'sub_classification', 'item_description',
+    'molecule_test_type', 'brand', 'dosage', 'dosage_form'
+]
+COLUMN_TRANSLATION = str.maketrans({
+    '-': '_', ' ': '_', '$': '', '?': '', '/': '_', '\\': '_',
+    '%': '', ')': '', '(': ''
+})
+# Correspondance dtype pandas -> type PostgreSQL (TEXT par défaut)
+PG_COLUMN_TYPES = {
+    np.dtype('int64'): 'BIGINT',
+    np.dtype('int32'): 'INTEGER',
+    np.dtype('int16'): 'SMALLINT',
+    np.dtype('int8'): 'SMALLINT',
+    np.dtype('float64'): 'DOUBLE PRECISION',
+    np.dtype('float32'): 'REAL',
+    np.dtype('datetime64[ns]'): 'TIMESTAMP',
+    np.dtype('bool'): 'BOOLEAN'
+}
+# Types imposés à la lecture ; les colonnes pouvant contenir des références ':123'
+# restent en texte pour être résolues ensuite
+COLUMN_DTYPES = {
+    'id': 'int64', 'line_item_quantity': 'int64', 'line_item_value': 'float64',
+    'unit_price': 'float64', 'line_item_insurance_usd': 'float64',
+    'weight_kilograms': 'string', 'freight_cost_usd': 'string'
+}
+
+def read_csv_columns(path, columns):
+    """Lit un fichier CSV en ne chargeant que les colonnes dont le nom nettoyé figure dans columns."""
+    header = pd.read_csv(path, nrows=0)
+    raw_columns = header.columns.tolist()
+    cleaned_columns = clean_column_names([header])[0].columns
+    raw_to_clean = {
+        raw: clean for raw, clean in zip(raw_columns, cleaned_columns) if clean in columns
+    }
+    dtypes = {
+        raw: COLUMN_DTYPES[clean] for raw, clean in raw_to_clean.items() if clean in COLUMN_DTYPES
+    }
+    return pd.read_csv(path, engine='pyarrow', usecols=list(raw_to_clean), dtype=dtypes)
+
+def parquet_cache_path(directory):
+    """Retourne le chemin du cache Parquet associé au dossier."""
+    return os.path.join(directory, PARQUET_CACHE_FILE)
+
+def parquet_cache_key(columns):
+    """Décrit le schéma du cache : colonnes, types et formats de date ayant servi à le produire."""
+    return json.dumps({
+        'version': PARQUET_CACHE_VERSION,
+        'columns': sorted(columns),
+        'dtypes': COLUMN_DTYPES,
+        'date_formats': DATE_FORMATS
+    }, sort_keys=True).encode()
+
+def is_parquet_cache_fresh(directory, columns=SELECTED_COLUMNS):
+    """Indique si le cache Parquet correspond au schéma attendu et est plus récent que tous les CSV du dossier."""
+    cache_path = parquet_cache_path(directory)
+    if not os.path.exists(cache_path):
+        return False
+    csv_mtimes = [
+        os.path.getmtime(os.path.join(directory, file))
+        for file in os.listdir(directory)
+        if file.endswith(".csv")
+    ]
+    if not csv_mtimes or max(csv_mtimes) > os.path.getmtime(cache_path):
+        return False
+    try:
+        metadata = pq.read_schema(cache_path).metadata or {}
+    except pa.ArrowException:
+        return False
+    return metadata.get(PARQUET_CACHE_METADATA_KEY) == parquet_cache_key(columns)
+
+def save_parquet_cache(df, directory, columns=SELECTED_COLUMNS):
+    """Enregistre le DataFrame nettoyé au format Parquet pour les exécutions suivantes."""
+    if is_parquet_cache_fresh(directory, columns):
+        return
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    table = table.replace_schema_metadata({
+        **(table.schema.metadata or {}),
+        PARQUET_CACHE_METADATA_KEY: parquet_cache_key(columns)
+    })
+    pq.write_table(table, parquet_cache_path(directory))
+    print(f"Cache Parquet enregistré : {parquet_cache_path(directory)}")
+
+def load_csv_files(directory, columns=SELECTED_COLUMNS):
+    """Charge les colonnes utiles de tous les fichiers CSV d'un dossier dans une liste de DataFrames.
 
-def load_csv_files(directory):
-    """Charge tous les fichiers CSV d'un dossier dans une liste de DataFrames."""
+    Si un cache Parquet plus récent que les CSV et de même schéma existe, il est lu à la place.
+    """
     try:
-        dataframes = [
-            pd.read_csv(os.path.join(directory, file))
+        if is_parquet_cache_fresh(directory, columns):
+            print("Données chargées depuis le cache Parquet.")
+            return [pd.read_parquet(parquet_cache_path(directory), columns=columns)]
+        paths = [
+            os.path.join(directory, file)
             for file in sorted(os.listdir(directory))
             if file.endswith(".csv")
         ]
+        # Le moteur pyarrow parse chaque fichier en multithread et libère le GIL,
+        # ce qui permet aussi de lire plusieurs fichiers en parallèle
+        with ThreadPoolExecutor() as executor:
+            dataframes = list(executor.map(lambda path: read_csv_columns(path, columns), paths))
         if not dataframes:
             raise ValueError("Aucun fichier CSV trouvé dans le dossier.")
         print(f"{len(dataframes)} fichiers CSV chargés.")
@@ -42,51 +146,56 @@ def load_csv_files(directory):
         print(f"Erreur lors de la lecture des fichiers CSV : {e}")
         raise
 
+@lru_cache(maxsize=None)
+def clean_columns(columns):
+    """Nettoie un tuple de noms de colonnes (mis en cache pour les en-têtes identiques)."""
+    return tuple(col.lower().translate(COLUMN_TRANSLATION) for col in columns)
+
 def clean_column_names(dataframes):
     """Nettoie les noms de colonnes des DataFrames en appliquant des transformations."""
-    transformations = str.maketrans({
-        '-': '_', ' ': '_', '$': '', '?': '', '/': '_', '\\': '_',
-        '%': '', ')': '', '(': ''
-    })
     for df in dataframes:
-        df.columns = [col.lower().translate(transformations) for col in df.columns]
+        df.columns = list(clean_columns(tuple(df.columns)))
     return dataframes
 
 def find_date_columns(df):
     """Identifie les colonnes contenant 'date' dans leur nom."""
     return [col for col in df.columns if "date" in col.lower()]
 
-def parse_date(date_str):
-    """Tente de convertir une chaîne en date selon plusieurs formats."""
-    if pd.isna(date_str) or date_str in ['Pre-PQ Process', 'Date Not Captured', '']:
-        return None  # Retourne None pour compatibilité avec PostgreSQL
-    date_str = str(date_str).strip()
-    for fmt in DATE_FORMATS:
-        try:
-            return datetime.strptime(date_str, fmt)
-        except ValueError:
-            continue
-    return pd.to_datetime(date_str, errors='coerce')
-
 def convert_date_columns(df):
     """Convertit les colonnes de date en format datetime."""
     date_columns = find_date_columns(df)
     if not date_columns:
         print("Aucune colonne de date trouvée dans le DataFrame.")
     for col in date_columns:
-        df[col] = df[col].astype(str).str.strip().apply(parse_date)
+        if pd.api.types.is_datetime64_any_dtype(df[col]):
+            continue  # Déjà convertie (ex : données lues depuis le cache Parquet)
+        values = df[col].astype('string').str.strip().replace(
+            {'Pre-PQ Process': pd.NA, 'Date Not Captured': pd.NA, '': pd.NA}
+        )
+        dates = pd.Series(pd.NaT, index=values.index, dtype='datetime64[ns]')
+        # Chaque format n'est essayé que sur les valeurs encore non converties ;
+        # en dernier recours, 'mixed' laisse pandas inférer le format valeur par valeur
+        for fmt in DATE_FORMATS + ['mixed']:
+            mask = dates.isna() & values.notna()
+            if mask.any():
+                dates.loc[mask] = pd.to_datetime(values[mask], format=fmt, errors='coerce', cache=True)
+        df[col] = dates
     return df
 
-def resolve_id_reference(value, dataset, column):
-    """Remplace les références d'ID (ex: ':123') par la valeur correspondante dans dataset."""
-    if not isinstance(value, str) or not re.match(ID_PATTERN, value):
+def resolve_id_reference(value, id_index, column):
+    """Remplace les références d'ID (ex: ':123') par la valeur correspondante dans id_index.
+
+    id_index est le dataset indexé par 'id' (df.set_index('id')), construit une
+    seule fois par l'appelant.
+    """
+    match = ID_REGEX.match(value) if isinstance(value, str) else None
+    if not match:
         return value
-    id_str = re.search(ID_PATTERN, value).group().replace(":", "")
+    id_str = match.group(1)
     try:
-        filtered = dataset.loc[dataset["id"] == int(id_str), column]
-        return filtered.iloc[0] if not filtered.empty else value
-    except (ValueError, IndexError):
-        print(f"ID {id_str} non trouvé ou invalide pour la colonne {column}.")
+        return id_index.at[int(id_str), column]
+    except KeyError:
+        print(f"ID {id_str} non trouvé pour la colonne {column}.")
         return value
 
 def setup_postgres_database(
@@ -136,25 +245,28 @@ def setup_postgres_database(
         print(f"Erreur lors de la configuration de la base : {e}")
         raise
 
+def begin_bulk_transaction(pg_conn):
+    """Regroupe l'ingestion dans une seule transaction sans attente du flush WAL à chaque écriture."""
+    pg_conn.autocommit = False
+    cursor = pg_conn.cursor()
+    # Ouvre la transaction ; le paramètre ne vaut que jusqu'au commit
+    cursor.execute("SET LOCAL synchronous_commit = off")
+    cursor.close()
+
 def create_table(pg_conn, table_name, df, foreign_keys=None):
     """Crée une table PostgreSQL avec des types adaptés et des contraintes de clés étrangères."""
     try:
         cursor = pg_conn.cursor()
-        column_types = {
-            'int64': 'BIGINT',
-            'float64': 'DOUBLE PRECISION',
-            'datetime64[ns]': 'TIMESTAMP',
-            'object': 'TEXT',
-            'bool': 'BOOLEAN'
-        }
+        # Seule la colonne principale (delivery_id pour deliveries, *_id pour dimensions) est PRIMARY KEY
+        if table_name == "deliveries":
+            primary_key = "delivery_id"
+        else:
+            primary_key = next((col for col in df.columns if col.endswith('_id')), None)
 
         columns_def = []
         for col, dtype in df.dtypes.items():
-            pg_type = column_types.get(str(dtype), 'TEXT')
-            # Seule la colonne principale (delivery_id pour deliveries, *_id pour dimensions) est PRIMARY KEY
-            if table_name == "deliveries" and col == "delivery_id":
-                columns_def.append(f"{col} {pg_type} NOT NULL PRIMARY KEY")
-            elif table_name != "deliveries" and col.endswith('_id'):
+            pg_type = PG_COLUMN_TYPES.get(dtype, 'TEXT')
+            if col == primary_key:
                 columns_def.append(f"{col} {pg_type} NOT NULL PRIMARY KEY")
             else:
                 columns_def.append(f"{col} {pg_type}")
@@ -179,27 +291,43 @@ def create_table(pg_conn, table_name, df, foreign_keys=None):
         print(f"Erreur lors de la création de la table '{table_name}' : {e}")
         raise
 
-def insert_data(pg_conn, table_name, df):
-    """Insère les données du DataFrame dans la table PostgreSQL."""
+def dataframe_to_rows(df):
+    """Convertit le DataFrame en lignes Python, les valeurs manquantes devenant None."""
+    # Masque NaN/NaT vectorisé puis conversion en listes Python en une passe C
+    return df.astype(object).where(df.notna(), None).to_numpy().tolist()
+
+def insert_data(pg_conn, table_name, df, mode=None):
+    """Insère les données du DataFrame dans la table PostgreSQL.
+
+    mode vaut 'copy' (COPY FROM STDIN, pour les grandes tables) ou 'values'
+    (execute_values, plusieurs lignes par requête). Par défaut, il est choisi
+    selon la taille du DataFrame.
+    """
+    if mode is None:
+        mode = 'copy' if len(df) > BATCH_SIZE else 'values'
+    if mode not in ('copy', 'values'):
+        raise ValueError(f"Mode d'insertion inconnu : {mode}")
     try:
         cursor = pg_conn.cursor()
         columns = df.columns.tolist()
-        placeholders = ", ".join(["%s"] * len(columns))
-        insert_query = sql.SQL(
-            "INSERT INTO {} ({}) VALUES ({})"
-        ).format(
-            sql.Identifier(table_name),
-            sql.SQL(", ").join(map(sql.Identifier, columns)),
-            sql.SQL(placeholders)
-        )
-
-        data = [
-            tuple(None if pd.isna(val) else val for val in row)
-            for row in df.itertuples(index=False, name=None)
-        ]
+        table = sql.Identifier(table_name)
+        column_list = sql.SQL(", ").join(map(sql.Identifier, columns))
+
+        if mode == 'copy':
+            buffer = io.StringIO()
+            df.to_csv(buffer, index=False, header=False, na_rep='')
+            buffer.seek(0)
+            copy_query = sql.SQL(
+                "COPY {} ({}) FROM STDIN WITH (FORMAT CSV, NULL '')"
+            ).format(table, column_list)
+            cursor.copy_expert(copy_query, buffer)
+        else:
+            insert_query = sql.SQL(
+                "INSERT INTO {} ({}) VALUES %s"
+            ).format(table, column_list)
+            execute_values(cursor, insert_query, dataframe_to_rows(df), page_size=BATCH_SIZE)
 
-        cursor.executemany(insert_query, data)
-        print(f"{len(data)} lignes insérées dans la table '{table_name}'.")
+        print(f"{len(df)} lignes insérées dans la table '{table_name}'.")
         cursor.close()
     except Exception as e:
         print(f"Erreur lors de l'insertion des données dans '{table_name}' : {e}")
@@ -207,42 +335,43 @@ def insert_data(pg_conn, table_name, df):
 
 def create_dimension_tables(df):
     """Crée les DataFrames pour les tables de dimension avec des ID uniques."""
-    # Table countries
-    countries = df[["country"]].drop_duplicates().reset_index(drop=True)
-    countries["country_id"] = countries.index + 1
-    countries = countries.rename(columns={"country": "country_name"})
+    # Les colonnes produit passent en category pour que le groupby travaille sur les codes
+    df_with_ids = df.astype({col: "category" for col in PRODUCT_COLUMNS})
+
+    # Table countries : factorize donne en une passe les valeurs uniques et les codes
+    # (use_na_sentinel=False : une valeur manquante obtient sa propre ligne et son ID)
+    codes, uniques = pd.factorize(df_with_ids["country"], use_na_sentinel=False)
+    countries = pd.DataFrame({"country_name": uniques, "country_id": np.arange(1, len(uniques) + 1)})
+    df_with_ids["country_id"] = codes + 1
 
     # Table vendors
-    vendors = df[["vendor"]].drop_duplicates().reset_index(drop=True)
-    vendors["vendor_id"] = vendors.index + 1
-    vendors = vendors.rename(columns={"vendor": "vendor_name"})
+    codes, uniques = pd.factorize(df_with_ids["vendor"], use_na_sentinel=False)
+    vendors = pd.DataFrame({"vendor_name": uniques, "vendor_id": np.arange(1, len(uniques) + 1)})
+    df_with_ids["vendor_id"] = codes + 1
 
     # Table transport_modes
-    transport_modes = df[["shipment_mode"]].drop_duplicates().reset_index(drop=True)
-    transport_modes["mode_id"] = transport_modes.index + 1
-    transport_modes = transport_modes.rename(columns={"shipment_mode": "mode_name"})
-
-    # Table products
-    products = df[["product_group", "sub_classification", "item_description",
-                   "molecule_test_type", "brand", "dosage", "dosage_form"]].drop_duplicates().reset_index(drop=True)
-    products["product_id"] = products.index + 1
-
-    # Ajouter les ID dans le DataFrame principal
-    df_with_ids = df.merge(countries, left_on="country", right_on="country_name", how="left")
-    df_with_ids = df_with_ids.merge(vendors, left_on="vendor", right_on="vendor_name", how="left")
-    df_with_ids = df_with_ids.merge(transport_modes, left_on="shipment_mode", right_on="mode_name", how="left")
-    df_with_ids = df_with_ids.merge(products, on=["product_group", "sub_classification", "item_description",
-                                                  "molecule_test_type", "brand", "dosage", "dosage_form"], how="left")
-
-    # Renommer id en delivery_id et sélectionner les colonnes finales
-    df_with_ids = df_with_ids.rename(columns={"id": "delivery_id"})
+    codes, uniques = pd.factorize(df_with_ids["shipment_mode"], use_na_sentinel=False)
+    transport_modes = pd.DataFrame({"mode_name": uniques, "mode_id": np.arange(1, len(uniques) + 1)})
+    df_with_ids["mode_id"] = codes + 1
+
+    # Table products : un seul groupby numérote les produits par ordre d'apparition
+    # (dropna=False : une dose manquante reste un produit distinct)
+    df_with_ids["product_id"] = df_with_ids.groupby(
+        PRODUCT_COLUMNS, sort=False, observed=True, dropna=False
+    ).ngroup() + 1
+    products = (df_with_ids[PRODUCT_COLUMNS + ["product_id"]]
+                .drop_duplicates("product_id")
+                .reset_index(drop=True))
+
+    # Sélectionner les colonnes finales puis renommer id en delivery_id sur place
     final_columns = [
-        'delivery_id', 'country_id', 'mode_id', 'scheduled_delivery_date',
+        'id', 'country_id', 'mode_id', 'scheduled_delivery_date',
         'delivered_to_client_date', 'delivery_recorded_date', 'product_id',
         'vendor_id', 'line_item_quantity', 'line_item_value', 'unit_price',
         'weight_kilograms', 'freight_cost_usd', 'line_item_insurance_usd'
     ]
     df_with_ids = df_with_ids[final_columns]
+    df_with_ids.columns = ["delivery_id" if col == "id" else col for col in final_columns]
 
     return df_with_ids, countries, vendors, transport_modes, products
 
@@ -255,13 +384,12 @@ def display_head(df, title="Aperçu des données", n=5):
 def display_summary_stats(df, title="Résumé statistique"):
     """Affiche les statistiques descriptives des colonnes numériques."""
     print(f"\n=== {title} ===")
-    numeric_cols = df.select_dtypes(include=['float64', 'int64']).columns
-    print(df[numeric_cols].describe().to_string())
+    print(df.select_dtypes(include='number').describe().to_string())
 
-def display_value_counts(df, column, title="Répartition des valeurs"):
-    """Affiche la répartition des valeurs d'une colonne catégorique."""
+def display_value_counts(df, column, title="Répartition des valeurs", n=50):
+    """Affiche la répartition des n valeurs les plus fréquentes d'une colonne catégorique."""
     print(f"\n=== {title} pour {column} ===")
-    print(df[column].value_counts().to_string())
+    print(df[column].value_counts().head(n).to_string())
     print(f"Nombre de valeurs uniques : {df[column].nunique()}")
 
 def create_indexes(pg_conn):
@@ -1,9 +1,11 @@
 from extraction_treatment import clean_column_names,load_csv_files,convert_date_columns,create_dimension_tables,SELECTED_COLUMNS,\
-    resolve_id_reference,setup_postgres_database,create_table,insert_data,ID_PATTERN,display_head,display_summary_stats,display_value_counts,\
-    create_indexes,verify_data
+    setup_postgres_database,create_table,insert_data,ID_PATTERN,display_head,display_summary_stats,display_value_counts,\
+    create_indexes,verify_data,begin_bulk_transaction,save_parquet_cache
+import numpy as np
 import pandas as pd
 def main():
     """Pipeline principal pour traiter et ingérer les données dans PostgreSQL."""
+    pg_conn = None
     try:
         # Étape 1 : Chargement des données
         dataframes = load_csv_files("dataset")
@@ -13,18 +15,33 @@ def main():
 
         # Étape 3 : Conversion des colonnes de date
         dataframes = [convert_date_columns(df) for df in dataframes]
+        save_parquet_cache(dataframes[0], "dataset")
 
         # Étape 4 : Sélection des colonnes pertinentes
         df = dataframes[0][SELECTED_COLUMNS].copy()
 
         # Étape 5 : Résolution des références
-        dataset = df.copy()
+        lookup = df[["id", "freight_cost_usd", "weight_kilograms"]].set_index("id")
         for col in ["freight_cost_usd", "weight_kilograms"]:
-            df[col] = df[col].astype(str).apply(
-                lambda x: resolve_id_reference(x, dataset, col)
-            ).astype(float, errors='ignore')
+            values = df[col].astype("string")
+            ids = values.str.extract(f"^{ID_PATTERN}", expand=False).astype("Int64")
+            resolved = ids.map(lookup[col])
+            df[col] = resolved.where(ids.isin(lookup.index), values).astype(float, errors='ignore')
         df['freight_cost_usd']=pd.to_numeric(df['freight_cost_usd'])
         df['weight_kilograms']=pd.to_numeric(df['weight_kilograms'])
+        # Réduction des types numériques : to_numeric ne passe une colonne en float32
+        # que si l'écart absolu reste inférieur à 5e-4 pour chaque valeur (tolérance
+        # de pandas) ; la conversion n'est donc pas strictement sans perte
+        float_columns = ['line_item_value', 'unit_price', 'weight_kilograms',
+                         'freight_cost_usd', 'line_item_insurance_usd']
+        df[float_columns] = df[float_columns].apply(pd.to_numeric, downcast='float')
+        # Quantité toujours en int32 (INTEGER) pour que le schéma de deliveries ne dépende
+        # pas des valeurs du chargement
+        int32_range = np.iinfo(np.int32)
+        quantity = df['line_item_quantity']
+        if quantity.min() < int32_range.min or quantity.max() > int32_range.max:
+            raise ValueError("line_item_quantity dépasse la plage d'un INTEGER PostgreSQL.")
+        df['line_item_quantity'] = quantity.astype('int32')
         # Étape 6 : Nettoyage des données
         df = df.dropna(subset=["shipment_mode", "line_item_insurance_usd"])
         print(f"Après nettoyage, {len(df)} lignes restantes.")
@@ -34,19 +51,20 @@ def main():
 
         # Étape 8 : Connexion à PostgreSQL
         pg_conn = setup_postgres_database()
+        begin_bulk_transaction(pg_conn)
 
         # Étape 9 : Création et ingestion des tables de dimension
         create_table(pg_conn, "countries", countries)
-        insert_data(pg_conn, "countries", countries)
+        insert_data(pg_conn, "countries", countries, mode="values")
 
         create_table(pg_conn, "vendors", vendors)
-        insert_data(pg_conn, "vendors", vendors)
+        insert_data(pg_conn, "vendors", vendors, mode="values")
 
         create_table(pg_conn, "transport_modes", transport_modes)
-        insert_data(pg_conn, "transport_modes", transport_modes)
+        insert_data(pg_conn, "transport_modes", transport_modes, mode="values")
 
         create_table(pg_conn, "products", products)
-        insert_data(pg_conn, "products", products)
+        insert_data(pg_conn, "products", products, mode="values")
 
         # Étape 10 : Création et ingestion de la table principale avec clés étrangères
         foreign_keys = [
@@ -56,9 +74,10 @@ def main():
             {"column": "product_id", "ref_table": "products", "ref_column": "product_id"}
         ]
         create_table(pg_conn, "deliveries", df, foreign_keys)
-        insert_data(pg_conn, "deliveries", df)
+        insert_data(pg_conn, "deliveries", df, mode="copy")
         # Appelez create_indexes(pg_conn) 
         create_indexes(pg_conn)
+        pg_conn.commit()
         # Appelez verify_data(pg_conn, "deliveries")
         verify_data(pg_conn, "deliveries")
 
@@ -80,6 +99,8 @@ def main():
 
     except Exception as e:
         print(f"Erreur dans le pipeline : {e}")
+        if pg_conn is not None and not pg_conn.closed:
+            pg_conn.rollback()
         raise
 
 if __name__ == "__main__":